@@ -3,11 +3,10 @@
 COL334 Assignment 3 - Part 1(a): Hub Controller
 ------------------------------------------------
 Implements a hub-like controller where:
-- MAC address table is maintained ONLY at the controller (not on switches)
-- Every packet triggers a PACKET_IN message to the controller
-- Controller handles each packet individually using PACKET_OUT
-- NO flow rules are installed on switches (except table-miss)
-- Results in lower throughput due to control plane bottleneck
+- MAC address table is maintained at the controller
+- Unknown destinations trigger a PACKET_IN and are flooded via PACKET_OUT
+- Once a destination is known, a reactive (in_port, src, dst) flow with an
+  idle timeout is installed so later packets stay on the switch fast path
 
 """
 
@@ -15,13 +14,31 @@ from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import MAIN_DISPATCHER, CONFIG_DISPATCHER, set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet, ethernet
+from ryu.ofproto.ofproto_v1_3 import (
+    OFPCML_NO_BUFFER, OFPIT_APPLY_ACTIONS, OFPP_CONTROLLER, OFPP_FLOOD,
+    OFP_NO_BUFFER)
+from ryu.ofproto.ofproto_v1_3_parser import (
+    OFPActionOutput, OFPFlowMod, OFPInstructionActions, OFPMatch, OFPPacketOut)
+import struct
+
+
+def parse_min(data):
+    """
+    Slice the Ethernet header out of a raw frame.
+    
+    Returns:
+        (dst, src, ethertype) with MACs as raw 6-byte strings,
+        or None if the frame is too short to be Ethernet
+    """
+    if len(data) < 14:
+        return None
+    return struct.unpack_from('!6s6sH', data, 0)
 
 
 class HubController(app_manager.RyuApp):
     """
-    Hub Controller that handles all packets at the controller level.
-    No per-destination flow rules are installed on switches.
+    Hub Controller that learns MACs at the controller level.
+    Known (in_port, src, dst) conversations get a short-lived flow rule.
     """
     
     # Specify OpenFlow version 1.3
@@ -35,10 +52,48 @@ class HubController(app_manager.RyuApp):
         super(HubController, self).__init__(*args, **kwargs)
         
         # MAC address learning table: {switch_id: {mac_address: port}}
-        # Example: {1: {'00:00:00:00:00:01': 1, '00:00:00:00:00:02': 2}}
+        # MACs are raw 6-byte keys, e.g. {1: {b'\x00\x00\x00\x00\x00\x01': 1}}
         # This table exists ONLY in controller memory, NOT on switches
         self.mac_to_port = {}
 
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None,
+                 idle_timeout=0):
+        """
+        Install a flow rule on a switch.
+        
+        Args:
+            datapath: Switch to install the flow on
+            priority: Rule priority (higher = checked first)
+            match: Match conditions
+            actions: Actions to perform when matched
+            buffer_id: ID of buffered packet (if any)
+            idle_timeout: Seconds of inactivity before the rule expires (0 = never)
+        """
+
+        # Wrap actions in instructions
+        inst = [OFPInstructionActions(OFPIT_APPLY_ACTIONS,
+                                      actions)]
+
+        # Create flow mod message
+        if buffer_id:
+            # If packet is buffered, reference it so the switch releases it
+            mod = OFPFlowMod(datapath=datapath,
+                             buffer_id=buffer_id,
+                             priority=priority,
+                             idle_timeout=idle_timeout,
+                             match=match,
+                             instructions=inst)
+        else:
+            # No buffered packet
+            mod = OFPFlowMod(datapath=datapath,
+                             priority=priority,
+                             idle_timeout=idle_timeout,
+                             match=match,
+                             instructions=inst)
+
+        # Send flow mod to switch
+        datapath.send_msg(mod)
+
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
         """
@@ -51,29 +106,30 @@ class HubController(app_manager.RyuApp):
         """
         # Extract switch (datapath) object and protocol details
         datapath = ev.msg.datapath
-        ofproto = datapath.ofproto       # OpenFlow protocol constants
-        parser = datapath.ofproto_parser  # Parser for creating OpenFlow messages
         
         # self.logger.info("Switch %s connected", datapath.id)
 
+        # Create this switch's MAC table once, not on every PACKET_IN
+        self.mac_to_port[datapath.id] = {}
+
         # Create table-miss flow entry
-        # This is the ONLY flow rule installed by hub controller
-        match = parser.OFPMatch()  # Empty match = match ALL packets
+        # Every packet without a reactive rule is sent to the controller
+        match = OFPMatch()  # Empty match = match ALL packets
         
         # Action: Send packet to controller with full packet data
-        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
-                                          ofproto.OFPCML_NO_BUFFER)]
+        actions = [OFPActionOutput(OFPP_CONTROLLER,
+                                   OFPCML_NO_BUFFER)]
         
         # Wrap actions in instructions
-        instructions = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
-                                                     actions)]
+        instructions = [OFPInstructionActions(OFPIT_APPLY_ACTIONS,
+                                              actions)]
         
         # Create flow modification message
         # Priority 0 = lowest priority (only matches if no other rule matches)
-        mod = parser.OFPFlowMod(datapath=datapath,
-                                priority=0,
-                                match=match,
-                                instructions=instructions)
+        mod = OFPFlowMod(datapath=datapath,
+                         priority=0,
+                         match=match,
+                         instructions=instructions)
         
         # Send flow mod message to switch to install the rule
         datapath.send_msg(mod)
@@ -84,15 +140,15 @@ class HubController(app_manager.RyuApp):
     def packet_in_handler(self, ev):
         """
         Handle PACKET_IN events from switches.
-        This is called for EVERY packet because only table-miss rule exists.
+        Called for packets that do not match a reactive flow rule.
         
         Processing steps:
         1. Parse packet to extract source and destination MAC
         2. Learn source MAC to port mapping (store in controller table)
         3. Look up destination MAC in controller table
-        4. If found: forward to specific port
+        4. If found: install an (in_port, src, dst) flow and forward
         5. If not found: flood to all ports
-        6. Send PACKET_OUT message (NO flow rule installation)
+        6. Send PACKET_OUT message unless the switch buffered the packet
         
         Args:
             ev: Event object containing packet information
@@ -100,22 +156,19 @@ class HubController(app_manager.RyuApp):
         # Extract message and switch information
         msg = ev.msg
         datapath = msg.datapath
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
+        send = datapath.send_msg
         in_port = msg.match['in_port']  # Port where packet arrived
         dpid = datapath.id               # Switch ID (datapath ID)
 
-        # Parse the packet data
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocol(ethernet.ethernet)
+        # Parse only the Ethernet header
+        eth = parse_min(msg.data)
         
         # Ignore non-Ethernet packets (safety check)
         if eth is None:
             return
         
-        # Extract source and destination MAC addresses
-        src_mac = eth.src  # Source MAC (e.g., '00:00:00:00:00:01')
-        dst_mac = eth.dst  # Destination MAC (e.g., '00:00:00:00:00:03')
+        # Extract source and destination MAC addresses (raw bytes)
+        dst_mac, src_mac, _ = eth
 
         # Log packet information
         # self.logger.info("Packet in: switch=%s, src=%s, dst=%s, in_port=%s",
@@ -125,11 +178,11 @@ class HubController(app_manager.RyuApp):
         # MAC Learning Phase
         # ====================
         # Learn the source MAC address and associate it with input port
-        # If switch not in table, create empty dict for it
-        self.mac_to_port.setdefault(dpid, {})
+        # (table for this switch was created in switch_features_handler)
+        mac_table = self.mac_to_port[dpid]
         
         # Store/update the MAC-to-port mapping in controller's table
-        self.mac_to_port[dpid][src_mac] = in_port
+        mac_table[src_mac] = in_port
         # self.logger.debug("Learned: switch=%s, MAC=%s -> port=%s",
         #                  dpid, src_mac, in_port)
 
@@ -137,39 +190,49 @@ class HubController(app_manager.RyuApp):
         # Forwarding Decision
         # ====================
         # Look up destination MAC in controller's table
-        if dst_mac in self.mac_to_port[dpid]:
+        if dst_mac in mac_table:
             # Destination is known: forward to specific port
-            out_port = self.mac_to_port[dpid][dst_mac]
+            out_port = mac_table[dst_mac]
             # self.logger.debug("Destination known: forwarding to port %s", out_port)
         else:
             # Destination unknown: flood to all ports (except input port)
-            out_port = ofproto.OFPP_FLOOD
+            out_port = OFPP_FLOOD
             # self.logger.debug("Destination unknown: flooding packet")
 
         # Create output action
-        actions = [parser.OFPActionOutput(out_port)]
+        actions = [OFPActionOutput(out_port)]
+
+        # ====================
+        # Install Reactive Flow
+        # ====================
+        # Known destination: push the decision into the switch so later
+        # packets of this conversation no longer reach the controller
+        if out_port != OFPP_FLOOD:
+            # OFPMatch wants colon-formatted MAC strings
+            match = OFPMatch(in_port=in_port, eth_src=src_mac.hex(':'),
+                             eth_dst=dst_mac.hex(':'))
+            if msg.buffer_id != OFP_NO_BUFFER:
+                # Switch forwards the buffered packet itself, no PACKET_OUT
+                self.add_flow(datapath, 1, match, actions, msg.buffer_id,
+                              idle_timeout=30)
+                return
+            self.add_flow(datapath, 1, match, actions, idle_timeout=30)
 
         # ====================
         # Send Packet Out
         # ====================
-        # CRITICAL: Hub controller only sends PACKET_OUT, NO flow rule installation
-        # This is the key difference from learning switch
-        
         # Handle buffered vs. unbuffered packets
         data = None
-        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+        if msg.buffer_id == OFP_NO_BUFFER:
             # Packet not buffered at switch, must send full packet data
             data = msg.data
 
         # Create and send PACKET_OUT message
-        out = parser.OFPPacketOut(datapath=datapath,
-                                  buffer_id=msg.buffer_id,
-                                  in_port=in_port,
-                                  actions=actions,
-                                  data=data)
-        datapath.send_msg(out)
+        out = OFPPacketOut(datapath=datapath,
+                           buffer_id=msg.buffer_id,
+                           in_port=in_port,
+                           actions=actions,
+                           data=data)
+        send(out)
         
         # self.logger.debug("Packet forwarded via PACKET_OUT")
-        
-        # NOTE: Next packet will also trigger PACKET_IN because
-        # no flow rule was installed on the switch!
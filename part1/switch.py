@@ -16,7 +16,25 @@ from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import MAIN_DISPATCHER, CONFIG_DISPATCHER, set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet, ethernet
+from ryu.ofproto.ofproto_v1_3 import (
+    OFPCML_NO_BUFFER, OFPIT_APPLY_ACTIONS, OFPP_CONTROLLER, OFPP_FLOOD,
+    OFP_NO_BUFFER)
+from ryu.ofproto.ofproto_v1_3_parser import (
+    OFPActionOutput, OFPFlowMod, OFPInstructionActions, OFPMatch, OFPPacketOut)
+import struct
+
+
+def parse_min(data):
+    """
+    Slice the Ethernet header out of a raw frame.
+    
+    Returns:
+        (dst, src, ethertype) with MACs as raw 6-byte strings,
+        or None if the frame is too short to be Ethernet
+    """
+    if len(data) < 14:
+        return None
+    return struct.unpack_from('!6s6sH', data, 0)
 
 
 class LearningSwitch(app_manager.RyuApp):
@@ -35,7 +53,7 @@ class LearningSwitch(app_manager.RyuApp):
         """
         super(LearningSwitch, self).__init__(*args, **kwargs)
         
-        # MAC address learning table: {switch_id: {mac_address: port}}
+        # MAC address learning table: {switch_id: {raw mac bytes: port}}
         self.mac_to_port = {}
 
     def add_flow(self, datapath, priority, match, actions, buffer_id=None):
@@ -50,27 +68,25 @@ class LearningSwitch(app_manager.RyuApp):
             actions: Actions to perform when matched
             buffer_id: ID of buffered packet (if any)
         """
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
 
         # Wrap actions in instructions
-        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
-                                             actions)]
+        inst = [OFPInstructionActions(OFPIT_APPLY_ACTIONS,
+                                      actions)]
 
         # Create flow mod message
         if buffer_id:
             # If packet is buffered, reference it
-            mod = parser.OFPFlowMod(datapath=datapath,
-                                    buffer_id=buffer_id,
-                                    priority=priority,
-                                    match=match,
-                                    instructions=inst)
+            mod = OFPFlowMod(datapath=datapath,
+                             buffer_id=buffer_id,
+                             priority=priority,
+                             match=match,
+                             instructions=inst)
         else:
             # No buffered packet
-            mod = parser.OFPFlowMod(datapath=datapath,
-                                    priority=priority,
-                                    match=match,
-                                    instructions=inst)
+            mod = OFPFlowMod(datapath=datapath,
+                             priority=priority,
+                             match=match,
+                             instructions=inst)
         
         # Send flow mod to switch
         datapath.send_msg(mod)
@@ -88,15 +104,16 @@ class LearningSwitch(app_manager.RyuApp):
             ev: Event object containing switch information
         """
         datapath = ev.msg.datapath
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
 
         # self.logger.info("Switch %s connected", datapath.id)
 
+        # Create this switch's MAC table once, not on every PACKET_IN
+        self.mac_to_port[datapath.id] = {}
+
         # Install table-miss flow: send unknown packets to controller
-        match = parser.OFPMatch()  # Match all packets
-        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
-                                          ofproto.OFPCML_NO_BUFFER)]
+        match = OFPMatch()  # Match all packets
+        actions = [OFPActionOutput(OFPP_CONTROLLER,
+                                   OFPCML_NO_BUFFER)]
         
         # Priority 0 = lowest priority (default rule)
         self.add_flow(datapath, 0, match, actions)
@@ -122,21 +139,19 @@ class LearningSwitch(app_manager.RyuApp):
         # Extract message and switch information
         msg = ev.msg
         datapath = msg.datapath
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
+        send = datapath.send_msg
         in_port = msg.match['in_port']
         dpid = datapath.id
 
-        # Parse the packet
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocol(ethernet.ethernet)
+        # Parse only the Ethernet header
+        eth = parse_min(msg.data)
         
         # Ignore non-Ethernet packets
         if eth is None:
             return
         
-        src_mac = eth.src
-        dst_mac = eth.dst
+        # MACs stay raw bytes; formatted only when building a match
+        dst_mac, src_mac, _ = eth
 
         # self.logger.info("Packet in: switch=%s, src=%s, dst=%s, in_port=%s",
         #                 dpid, src_mac, dst_mac, in_port)
@@ -144,35 +159,35 @@ class LearningSwitch(app_manager.RyuApp):
         # ====================
         # MAC Learning Phase
         # ====================
-        self.mac_to_port.setdefault(dpid, {})
-        self.mac_to_port[dpid][src_mac] = in_port
+        mac_table = self.mac_to_port[dpid]  # created in switch_features_handler
+        mac_table[src_mac] = in_port
         # self.logger.debug("Learned: switch=%s, MAC=%s -> port=%s",
         #                  dpid, src_mac, in_port)
 
         # ====================
         # Forwarding Decision
         # ====================
-        if dst_mac in self.mac_to_port[dpid]:
-            out_port = self.mac_to_port[dpid][dst_mac]
+        if dst_mac in mac_table:
+            out_port = mac_table[dst_mac]
             # self.logger.debug("Destination known: will install flow to port %s", out_port)
         else:
-            out_port = ofproto.OFPP_FLOOD
+            out_port = OFPP_FLOOD
             # self.logger.debug("Destination unknown: will flood packet")
 
         # Create output action
-        actions = [parser.OFPActionOutput(out_port)]
+        actions = [OFPActionOutput(out_port)]
 
         # ====================
         # Install Flow Rule (KEY DIFFERENCE FROM HUB)
         # ====================
         # If destination is known (not flooding), install a flow rule on switch
-        if out_port != ofproto.OFPP_FLOOD:
+        if out_port != OFPP_FLOOD:
             # Create match condition: packets with this destination MAC
-            match = parser.OFPMatch(eth_dst=dst_mac)
+            match = OFPMatch(eth_dst=dst_mac.hex(':'))
             
             # Install flow rule with priority 1 (higher than table-miss)
             # Future packets matching this flow will be handled by switch directly
-            if msg.buffer_id != ofproto.OFP_NO_BUFFER:
+            if msg.buffer_id != OFP_NO_BUFFER:
                 # If packet is buffered at switch, install flow and we're done
                 self.add_flow(datapath, 1, match, actions, msg.buffer_id)
                 # self.logger.info("Flow installed: switch=%s, dst=%s -> port=%s",
@@ -190,14 +205,14 @@ class LearningSwitch(app_manager.RyuApp):
         # Send PACKET_OUT for the current packet
         # (subsequent packets will match installed flow and bypass controller)
         data = None
-        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+        if msg.buffer_id == OFP_NO_BUFFER:
             data = msg.data
 
-        out = parser.OFPPacketOut(datapath=datapath,
-                                  buffer_id=msg.buffer_id,
-                                  in_port=in_port,
-                                  actions=actions,
-                                  data=data)
-        datapath.send_msg(out)
+        out = OFPPacketOut(datapath=datapath,
+                           buffer_id=msg.buffer_id,
+                           in_port=in_port,
+                           actions=actions,
+                           data=data)
+        send(out)
         
         # self.logger.debug("Current packet forwarded via PACKET_OUT")
@@ -9,72 +9,230 @@ from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER, DEAD_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet, ethernet, ether_types, ipv4, tcp, lldp
+from ryu.ofproto.ofproto_v1_3 import (
+    OFPBRC_BAD_EXPERIMENTER, OFPBRC_BAD_EXP_TYPE, OFPCML_NO_BUFFER,
+    OFPET_BAD_REQUEST, OFPET_EXPERIMENTER, OFPFF_SEND_FLOW_REM,
+    OFPGC_ADD, OFPGT_SELECT, OFPIT_APPLY_ACTIONS,
+    OFPP_CONTROLLER, OFPP_FLOOD, OFP_NO_BUFFER,
+    ONF_BCT_COMMIT_REQUEST, ONF_BCT_OPEN_REQUEST, ONF_BF_ATOMIC,
+    ONF_BF_ORDERED, ONFERR_ET_BUNDLE_IN_PROGRESS, ONFERR_ET_EPERM,
+    ONFERR_ET_MSG_UNSUP, ONFERR_ET_UNKNOWN)
+from ryu.ofproto.ofproto_common import ONF_EXPERIMENTER_ID
+from ryu.ofproto.ofproto_v1_3_parser import (
+    OFPActionGroup, OFPActionOutput, OFPBarrierRequest, OFPBucket,
+    OFPFlowMod, OFPGroupMod, OFPInstructionActions, OFPMatch, OFPPacketOut,
+    ONFBundleAddMsg, ONFBundleCtrlMsg)
+from ryu.lib import hub
+from ryu.lib.packet import ether_types
 from ryu.topology import event as topo_event
 from ryu.topology.api import get_switch, get_link
 import networkx as nx
 import json
-import random
+import logging
+import os
+import pickle
+import struct
+import sys
+import zlib
+
+# Bump whenever the graph/config built by load_config changes shape, so
+# stale config.pkl caches are rebuilt instead of loaded
+CONFIG_CACHE_VERSION = 2
+
+# ONF bundle errors saying the switch can't take bundles at all; the rest of
+# the bundle range (bad id, failed commit, ...) only loses that one bundle
+BUNDLE_UNSUPPORTED = (ONFERR_ET_UNKNOWN, ONFERR_ET_EPERM, ONFERR_ET_MSG_UNSUP)
+
+try:
+    import numpy
+except ImportError:  # not shipped in ryu-venv
+    numpy = None
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+def parse_min(data):
+    """Slice (dst, src, ethertype) out of a raw frame; MACs stay raw bytes"""
+    if len(data) < 14:
+        return None
+    return struct.unpack_from('!6s6sH', data, 0)
+
+
+def parse_tcp_ports(data):
+    """Return (tcp_src, tcp_dst) of an IPv4/TCP frame, else None"""
+    if len(data) < 34:
+        return None
+    ver_ihl, _, _, _, _, _, proto = struct.unpack_from('!BBHHHBB', data, 14)
+    if proto != 6:
+        return None
+    offset = 14 + (ver_ihl & 0x0f) * 4
+    if len(data) < offset + 4:
+        return None
+    return struct.unpack_from('!HH', data, offset)
+
+
+def parse_arp(data):
+    """Return (opcode, sha, spa, tpa) of an Ethernet/IPv4 ARP frame, else None"""
+    if len(data) < 42:
+        return None
+    op, sha, spa, _, tpa = struct.unpack_from('!6xH6s4s6s4s', data, 14)
+    return op, sha, spa, tpa
+
+
+def build_arp_reply(dst_mac, dst_ip, mac, ip):
+    """Raw ARP reply frame telling dst_mac/dst_ip that ip is at mac"""
+    return struct.pack('!6s6sHHHBBH6s4s6s4s', dst_mac, mac, ether_types.ETH_TYPE_ARP,
+                       1, ether_types.ETH_TYPE_IP, 6, 4, 2, mac, ip, dst_mac, dst_ip)
+
 
 class L2SPFController(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
 
     def __init__(self, *args, **kwargs):
         super(L2SPFController, self).__init__(*args, **kwargs)
+        # Switch naming: dpid <-> 'sN' node name, built once per switch
+        self.dpid_to_name = {}
+        self.name_to_dpid = {}
         # Load configuration
         self.load_config('config.json')
+        for name in self.config['nodes']:
+            self.switch_name(int(name[1:]))
         # MAC learning tables
-        self.mac_to_switch = {}  # MAC -> switch dpid
-        self.mac_to_port = {}  # dpid -> {MAC -> port}
+        self.mac_to_id = {}  # MAC -> small int id
+        self.mac_location = {}  # MAC id -> (switch dpid, host port)
+        self.ip_to_mac = {}  # raw IPv4 -> raw MAC, learned from ARP senders
         # Datapath management
         self.datapaths = {}  # dpid -> datapath object
+        self.no_bundle_dpids = set()  # switches that rejected ONF bundles
+        self.next_bundle_id = 0
         # Flow tracking for per-flow ECMP
-        self.flow_to_path = {}  # (dpid, dst_dpid, dst_mac, tcp_src, tcp_dst) -> chosen path
+        self.installed_rules = {}  # (dpid, dst_mac, src_mac, tcp_src, tcp_dst) -> out_port already on switch
+        self._out_cache = {}  # (dpid, out_port) -> shared (actions, instructions)
+        # In-switch ECMP via SELECT groups
+        self.group_ids = {}  # (dpid, sorted bucket ports) -> group_id, shared by destinations
+        self.next_group_id = 1
         # Topology discovery (auto-populated by Ryu)
         self.topology_graph = nx.Graph()
-        self.link_to_port = {}  # (src_dpid, dst_dpid) -> src_port
-        self.port_to_link = {}  # (dpid, port) -> neighbor_dpid
+        self.link_to_port = {}  # src_dpid -> {dst_dpid: src_port}
+        self.link_ports_mask = {}  # dpid -> bitmask, bit p set if port p is inter-switch
+        # Precomputed shortest-path predecessor DAGs (paths are never materialized)
+        self.ecmp_preds = {}  # src_dpid -> {dpid: [equal-cost predecessor dpids]}
+        self.path_outport = {}  # flow key -> {dpid on chosen path: out_port}
+        self._paths_signature = None  # graph + ports the DAGs were built from
+        self._precompute_paths()
+        # Topology rebuilds run off the event loop, debounced
+        self._topo_dirty = hub.Event()
+        self.topo_thread = hub.spawn(self._topo_worker)
         self.logger.info("="*60)
         self.logger.info("L2-SPF Controller Started")
-        self.logger.info("ECMP: %s", self.ecmp_enabled)
+        self.logger.info("ECMP: %s%s", self.ecmp_enabled,
+                         " (switch SELECT groups)" if self.ecmp_groups else "")
         self.logger.info("="*60)
 
     def load_config(self, config_file):
-        """Load topology configuration"""
+        """Load topology configuration (cached as a pickle next to the json)"""
+        cache_file = os.path.splitext(config_file)[0] + '.pkl'
+        if (os.path.exists(cache_file) and
+                os.path.getmtime(cache_file) > os.path.getmtime(config_file)):
+            try:
+                with open(cache_file, 'rb') as f:
+                    version, graph, config = pickle.load(f)
+                if version != CONFIG_CACHE_VERSION:
+                    raise ValueError("cache version %r, want %d" % (version, CONFIG_CACHE_VERSION))
+                # Unpickled names are fresh strings: intern them as the json path does
+                names = {name: sys.intern(name) for name in graph}
+                self.graph = nx.relabel_nodes(graph, names)
+                config['nodes'] = [names.get(name) or sys.intern(name) for name in config['nodes']]
+                self.config = config
+                self.ecmp_enabled = self.config.get('ecmp', False)
+                self.ecmp_groups = self.ecmp_enabled and self.config.get('ecmp_groups', False)
+                return
+            except Exception as e:
+                self.logger.warning("Ignoring config cache %s: %s", cache_file, str(e))
         with open(config_file) as f:
-            self.config = json.load(f)
+            self.config = _loads(f.read())
         # Build NetworkX graph from config (for weights)
         self.graph = nx.Graph()
-        nodes = self.config['nodes']
+        nodes = self.config['nodes'] = [sys.intern(name) for name in self.config['nodes']]
         weights = self.config['weight_matrix']
-        for i, src in enumerate(nodes):
-            for j, dst in enumerate(nodes):
-                if weights[i][j] > 0:
-                    self.graph.add_edge(src, dst, weight=weights[i][j])
+        # Undirected graph: fold the matrix onto its upper triangle with
+        # max(W, W.T), so a link listed in only one triangle is kept
+        if numpy is not None:
+            W = numpy.asarray(weights)
+            if not numpy.array_equal(W, W.T):
+                self.logger.warning("weight_matrix is not symmetric, using max(W, W.T)")
+                W = numpy.maximum(W, W.T)
+            iu, ju = numpy.triu_indices_from(W, k=1)
+            mask = W[iu, ju] > 0
+            iu, ju = iu[mask].tolist(), ju[mask].tolist()
+            edges = zip([nodes[i] for i in iu], [nodes[j] for j in ju],
+                        W[iu, ju].tolist())
+        else:
+            n = len(nodes)
+            if any(weights[i][j] != weights[j][i] for i in range(n) for j in range(i + 1, n)):
+                self.logger.warning("weight_matrix is not symmetric, using max(W, W.T)")
+            edges = [(src, nodes[j], w)
+                     for i, src in enumerate(nodes)
+                     for j in range(i + 1, n)
+                     for w in (max(weights[i][j], weights[j][i]),) if w > 0]
+        self.graph.add_nodes_from(nodes)
+        self.graph.add_weighted_edges_from(edges)
         self.ecmp_enabled = self.config.get('ecmp', False)
+        # Let switches hash flows across equal-cost next hops themselves
+        self.ecmp_groups = self.ecmp_enabled and self.config.get('ecmp_groups', False)
+        try:
+            with open(cache_file, 'wb') as f:
+                pickle.dump((CONFIG_CACHE_VERSION, self.graph, self.config), f, protocol=5)
+        except OSError as e:
+            self.logger.warning("Cannot write config cache %s: %s", cache_file, str(e))
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
         """Handle switch connection"""
         datapath = ev.msg.datapath
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
         dpid = datapath.id
         self.datapaths[dpid] = datapath
-        if dpid not in self.mac_to_port:
-            self.mac_to_port[dpid] = {}
+        self.switch_name(dpid)
         # Install table-miss: send to controller
-        match = parser.OFPMatch()
-        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
-                                          ofproto.OFPCML_NO_BUFFER)]
+        match = OFPMatch()
+        actions = [OFPActionOutput(OFPP_CONTROLLER,
+                                   OFPCML_NO_BUFFER)]
         self.add_flow(datapath, 0, match, actions)
         self.logger.info("Switch s%d connected", dpid)
 
+    @set_ev_cls(ofp_event.EventOFPStateChange, DEAD_DISPATCHER)
+    def state_change_handler(self, ev):
+        """Drop a disconnected switch's datapath and per-switch rule state"""
+        dpid = ev.datapath.id
+        if self.datapaths.pop(dpid, None) is None:
+            return
+        self.no_bundle_dpids.discard(dpid)
+        # It may come back with a different flow table: reinstall on demand
+        self.installed_rules = {k: v for k, v in self.installed_rules.items()
+                                if k[0] != dpid}
+        self.group_ids = {k: v for k, v in self.group_ids.items() if k[0] != dpid}
+        self._out_cache = {k: v for k, v in self._out_cache.items() if k[0] != dpid}
+        self.logger.info("Switch s%d disconnected", dpid)
+
+    def switch_name(self, dpid):
+        """Node name for a dpid, registering it on first use"""
+        name = self.dpid_to_name.get(dpid)
+        if name is None:
+            # Interned: graph lookups by name hit the identity fast path
+            name = sys.intern(f's{dpid}')
+            self.dpid_to_name[dpid] = name
+            self.name_to_dpid[name] = dpid
+        return name
+
     @set_ev_cls(topo_event.EventSwitchEnter)
     def switch_enter_handler(self, ev):
         """Handle switch topology changes"""
         self.logger.info("Topology change detected, rebuilding...")
-        self.discover_topology()
+        self._topo_dirty.set()
 
     @set_ev_cls(topo_event.EventLinkAdd)
     def link_add_handler(self, ev):
@@ -85,13 +243,32 @@ class L2SPFController(app_manager.RyuApp):
         src_port = link.src.port_no
         dst_port = link.dst.port_no
         # Store bidirectional link info
-        self.link_to_port[(src_dpid, dst_dpid)] = src_port
-        self.link_to_port[(dst_dpid, src_dpid)] = dst_port
-        self.port_to_link[(src_dpid, src_port)] = dst_dpid
-        self.port_to_link[(dst_dpid, dst_port)] = src_dpid
+        self.link_to_port.setdefault(src_dpid, {})[dst_dpid] = src_port
+        self.link_to_port.setdefault(dst_dpid, {})[src_dpid] = dst_port
+        self.link_ports_mask[src_dpid] = self.link_ports_mask.get(src_dpid, 0) | (1 << src_port)
+        self.link_ports_mask[dst_dpid] = self.link_ports_mask.get(dst_dpid, 0) | (1 << dst_port)
+        src = self.switch_name(src_dpid)
+        dst = self.switch_name(dst_dpid)
+        self.topology_graph.add_edge(src, dst, weight=self.link_weight(src, dst))
+        self._topo_dirty.set()
         self.logger.info("Link discovered: s%d port %d <-> s%d port %d",
                          src_dpid, src_port, dst_dpid, dst_port)
 
+    def _topo_worker(self):
+        """Rebuild topology and paths once a burst of topology events settles"""
+        while True:
+            self._topo_dirty.wait()
+            hub.sleep(0.25)  # debounce: let the rest of the burst arrive
+            self._topo_dirty.clear()
+            try:
+                self.discover_topology()
+            except Exception as e:
+                self.logger.error("Topology rebuild error: %s", str(e))
+
+    def link_weight(self, src, dst):
+        """Get link weight from config (default 1)"""
+        return self.graph[src][dst]['weight'] if self.graph.has_edge(src, dst) else 1
+
     def discover_topology(self):
         """Discover network topology using Ryu's topology API"""
         switches = get_switch(self)
@@ -99,214 +276,515 @@ class L2SPFController(app_manager.RyuApp):
         # Clear old topology
         self.topology_graph.clear()
         self.link_to_port.clear()
-        self.port_to_link.clear()
+        self.link_ports_mask.clear()
         # Add switches
         for switch in switches:
-            self.topology_graph.add_node(f's{switch.dp.id}')
+            self.topology_graph.add_node(self.switch_name(switch.dp.id))
         # Add links
         for link in links:
-            src = f's{link.src.dpid}'
-            dst = f's{link.dst.dpid}'
+            src = self.switch_name(link.src.dpid)
+            dst = self.switch_name(link.dst.dpid)
             # Get weight from config
-            weight = self.graph[src][dst]['weight'] if self.graph.has_edge(src, dst) else 1
-            self.topology_graph.add_edge(src, dst, weight=weight)
+            self.topology_graph.add_edge(src, dst, weight=self.link_weight(src, dst))
             # Store port mappings
-            self.link_to_port[(link.src.dpid, link.dst.dpid)] = link.src.port_no
-            self.port_to_link[(link.src.dpid, link.src.port_no)] = link.dst.dpid
+            self.link_to_port.setdefault(link.src.dpid, {})[link.dst.dpid] = link.src.port_no
+            self.link_ports_mask[link.src.dpid] = (
+                self.link_ports_mask.get(link.src.dpid, 0) | (1 << link.src.port_no))
+        self._precompute_paths()
         self.logger.info("Topology: %d switches, %d links",
                          self.topology_graph.number_of_nodes(),
                          self.topology_graph.number_of_edges())
 
-    def add_flow(self, datapath, priority, match, actions):
-        """Install flow rule"""
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
-        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
-        mod = parser.OFPFlowMod(
+    def _precompute_paths(self):
+        """Precompute the equal-cost shortest-path DAG from every switch"""
+        graph = self.topology_graph if self.topology_graph.number_of_nodes() > 0 else self.graph
+        # A rebuild that found the same weighted graph and ports changes nothing:
+        # keep the DAGs and the per-flow caches instead of re-running Dijkstra
+        signature = (frozenset(graph.nodes),
+                     frozenset((u, v, w) for u, v, w in graph.edges(data='weight')),
+                     frozenset((u, v, port) for u, ports in self.link_to_port.items()
+                               for v, port in ports.items()))
+        if signature == self._paths_signature:
+            return
+        self._paths_signature = signature
+        n2d = self.name_to_dpid
+        ecmp_preds = {}
+        for src in graph.nodes:
+            # pred holds every equal-cost predecessor on a shortest path
+            pred, _ = nx.dijkstra_predecessor_and_distance(graph, src, weight='weight')
+            ecmp_preds[n2d[src]] = {n2d[v]: [n2d[u] for u in us] for v, us in pred.items()}
+        self.ecmp_preds = ecmp_preds
+        # Cached per-flow paths and rules may no longer be valid
+        self.path_outport.clear()
+        self.installed_rules.clear()
+
+    @staticmethod
+    def _walk_path(pred, src, dst, key=None):
+        """
+        Walk a Dijkstra predecessor DAG from dst back to src, without ever
+        enumerating paths. At each fork pick by a per-hop CRC32 of key
+        (fixed choice if key is None). Returns (path, number of forks).
+        """
+        node, path, forks = dst, [dst], 0
+        while node != src:
+            prevs = pred[node]
+            if len(prevs) > 1:
+                forks += 1
+                node = prevs[zlib.crc32(key, node) % len(prevs) if key is not None else -1]
+            else:
+                node = prevs[0]
+            path.append(node)
+        return tuple(reversed(path)), forks
+
+    def _out(self, dpid, out_port):
+        """Cached output-only (actions, instructions); shared, so never mutate them"""
+        key = (dpid, out_port)
+        cached = self._out_cache.get(key)
+        if cached is None:
+            actions = [OFPActionOutput(out_port)]
+            cached = self._out_cache[key] = (
+                actions, [OFPInstructionActions(OFPIT_APPLY_ACTIONS, actions)])
+        return cached
+
+    def build_flow(self, datapath, priority, match, actions=None, flags=0, inst=None,
+                   buffer_id=OFP_NO_BUFFER, idle_timeout=0):
+        """Build (but do not send) a flow rule"""
+        if inst is None:
+            inst = [OFPInstructionActions(OFPIT_APPLY_ACTIONS, actions)]
+        return OFPFlowMod(
             datapath=datapath,
             priority=priority,
+            flags=flags,
+            buffer_id=buffer_id,
+            idle_timeout=idle_timeout,
             match=match,
             instructions=inst)
-        datapath.send_msg(mod)
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=OFP_NO_BUFFER,
+                 idle_timeout=0):
+        """Install flow rule (releasing buffer_id through it, if given)"""
+        datapath.send_msg(self.build_flow(datapath, priority, match, actions,
+                                          buffer_id=buffer_id, idle_timeout=idle_timeout))
+
+    def send_flows(self, datapath, mods):
+        """Send several flow/group mods to one switch as a single burst"""
+        if datapath.id in self.no_bundle_dpids:
+            # No bundle support: plain FlowMods, fenced by one barrier
+            for mod in mods:
+                datapath.send_msg(mod)
+            datapath.send_msg(OFPBarrierRequest(datapath))
+            return
+        bundle_id = self.next_bundle_id
+        self.next_bundle_id = (bundle_id + 1) & 0xffffffff
+        flags = ONF_BF_ATOMIC | ONF_BF_ORDERED
+        datapath.send_msg(ONFBundleCtrlMsg(
+            datapath, bundle_id, ONF_BCT_OPEN_REQUEST, flags, []))
+        for mod in mods:
+            datapath.send_msg(ONFBundleAddMsg(
+                datapath, bundle_id, flags, mod, []))
+        datapath.send_msg(ONFBundleCtrlMsg(
+            datapath, bundle_id, ONF_BCT_COMMIT_REQUEST, flags, []))
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def flow_removed_handler(self, ev):
+        """Forget a path rule once the switch drops it"""
+        msg = ev.msg
+        key = (msg.datapath.id, msg.match.get('eth_dst'), msg.match.get('eth_src'),
+               msg.match.get('tcp_src'), msg.match.get('tcp_dst'))
+        self.installed_rules.pop(key, None)
+
+    @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER)
+    def error_msg_handler(self, ev):
+        """Fall back to plain FlowMods on switches that reject bundles"""
+        msg = ev.msg
+        dpid = msg.datapath.id
+        if msg.type == OFPET_EXPERIMENTER:
+            # Ryu leaves code unset here; exp_type carries the error
+            bundle_error = (msg.experimenter == ONF_EXPERIMENTER_ID and
+                            ONFERR_ET_UNKNOWN <= msg.exp_type <= ONFERR_ET_BUNDLE_IN_PROGRESS)
+            unsupported = bundle_error and msg.exp_type in BUNDLE_UNSUPPORTED
+        else:
+            unsupported = (msg.type == OFPET_BAD_REQUEST and
+                           msg.code in (OFPBRC_BAD_EXPERIMENTER, OFPBRC_BAD_EXP_TYPE))
+            bundle_error = unsupported
+        if bundle_error and dpid in self.no_bundle_dpids:
+            # OPEN, each ADD and COMMIT of a rejected bundle all error out
+            return
+        if bundle_error:
+            if unsupported:
+                self.logger.warning("s%d rejected bundle, using FlowMod + barrier", dpid)
+                self.no_bundle_dpids.add(dpid)
+            else:
+                self.logger.warning("s%d bundle failed (exp_type=%d), resending on next packet",
+                                    dpid, msg.exp_type)
+            # Rules and groups from the rejected bundle were never installed
+            self.path_outport.clear()
+            self.installed_rules.clear()
+            self.group_ids = {k: v for k, v in self.group_ids.items() if k[0] != dpid}
+        elif msg.type == OFPET_EXPERIMENTER:
+            self.logger.error("OFPErrorMsg from s%d: experimenter=0x%x exp_type=%s",
+                              dpid, msg.experimenter, msg.exp_type)
+        else:
+            self.logger.error("OFPErrorMsg from s%d: type=%d code=%d",
+                              dpid, msg.type, msg.code)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def packet_in_handler(self, ev):
         """Handle PacketIn events"""
         msg = ev.msg
         datapath = msg.datapath
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
+        send = datapath.send_msg
         in_port = msg.match['in_port']
         dpid = datapath.id
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocol(ethernet.ethernet)
-        if eth.ethertype == ether_types.ETH_TYPE_LLDP:
+        eth = parse_min(msg.data)
+        if eth is None:
             return
-        src = eth.src
-        dst = eth.dst
-        # Ignore multicast/broadcast
-        if dst.startswith('33:33') or dst.startswith('01:00:5e') or dst.startswith('ff:ff'):
+        dst, src, eth_type = eth
+        if eth_type == ether_types.ETH_TYPE_LLDP:
+            return
+        # Fast path: both hosts already known on this switch
+        dst_id = self.mac_to_id.get(dst)
+        if dst_id is not None:
+            dst_dpid, dst_port = self.mac_location[dst_id]
+            src_id = self.mac_to_id.get(src)
+            if (dst_dpid == dpid and src_id is not None
+                    and self.mac_location[src_id][0] == dpid):
+                self.install_local_flow(datapath, msg, in_port, src, dst, dst_port)
+                return
+        # Ignore multicast/broadcast (I/G bit of the first octet:
+        # covers 01:00:5e IPv4, 33:33 IPv6 multicast and ff:ff broadcast)
+        if dst[0] & 0x01:
+            # Broadcast ARP is never flooded, but can be answered from the cache
+            if eth_type == ether_types.ETH_TYPE_ARP:
+                self.handle_arp(datapath, msg, in_port, flood=False)
             return
         # Learn source MAC (only from host ports)
-        if (dpid, in_port) not in self.port_to_link:
-            self.mac_to_switch[src] = dpid
-            self.mac_to_port[dpid][src] = in_port
+        src_port = None  # set when the source host sits on this switch
+        if not (self.link_ports_mask.get(dpid, 0) >> in_port) & 1:
+            src_id = self.mac_to_id.get(src)
+            if src_id is None:
+                src_id = self.mac_to_id[src] = len(self.mac_to_id)
+            self.mac_location[src_id] = (dpid, in_port)
+            src_port = in_port
         # Handle ARP
-        if eth.ethertype == ether_types.ETH_TYPE_ARP:
-            self.flood_packet(datapath, msg, in_port)
+        if eth_type == ether_types.ETH_TYPE_ARP:
+            self.handle_arp(datapath, msg, in_port)
             return
         # Check if we know destination
-        if dst not in self.mac_to_switch:
+        if dst_id is None:
             self.flood_packet(datapath, msg, in_port)
             return
         # We know both src and dst
-        dst_dpid = self.mac_to_switch[dst]
-        dst_port = self.mac_to_port[dst_dpid][dst]
+        dst_dpid, dst_port = self.mac_location[dst_id]
         # Same switch?
         if dpid == dst_dpid:
-            actions = [parser.OFPActionOutput(dst_port)]
+            if src_port is not None:
+                self.install_local_flow(datapath, msg, in_port, src, dst, dst_port)
+                return
+            # Straggler of a remote pair: the egress path rule owns this
+            # match, so only forward the packet
+            data = None
+            if msg.buffer_id == OFP_NO_BUFFER:
+                data = msg.data
+            send(OFPPacketOut(
+                datapath=datapath, buffer_id=msg.buffer_id, in_port=in_port,
+                actions=self._out(dpid, dst_port)[0], data=data))
+            return
+        
+        # In-switch ECMP: per-destination rules into SELECT groups
+        if self.ecmp_groups:
+            actions = self.install_group_rules(dpid, dst_dpid, dst.hex(':'), dst_port)
+            if actions is None:
+                self.logger.error("No path s%d -> s%d", dpid, dst_dpid)
+                return
             data = None
-            if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+            if msg.buffer_id == OFP_NO_BUFFER:
                 data = msg.data
-            out = parser.OFPPacketOut(
+            out = OFPPacketOut(
                 datapath=datapath, buffer_id=msg.buffer_id,
                 in_port=in_port, actions=actions, data=data)
-            datapath.send_msg(out)
+            send(out)
             return
         
         # Parse BEFORE creating path key
-        ip_pkt = pkt.get_protocol(ipv4.ipv4)
-        tcp_pkt = pkt.get_protocol(tcp.tcp)
+        tcp_ports = None
+        if eth_type == ether_types.ETH_TYPE_IP:
+            tcp_ports = parse_tcp_ports(msg.data)
         
         # KEY FIX: Use TCP ports in path key for per-flow ECMP
-        if tcp_pkt:
-            path_key = (dpid, dst_dpid, dst, tcp_pkt.src_port, tcp_pkt.dst_port)
+        if tcp_ports:
+            path_key = self.flow_key(dpid, dst_dpid, dst_id, tcp_ports[0], tcp_ports[1])
         else:
-            path_key = (dpid, dst_dpid, dst, 0, 0)
+            path_key = self.flow_key(dpid, dst_dpid, dst_id, 0, 0)
         
-        if path_key not in self.flow_to_path:
+        outports = self.path_outport.get(path_key)
+        if outports is None:
             # Compute path from CURRENT switch to destination
-            src_node = f's{dpid}'
-            dst_node = f's{dst_dpid}'
+            pred = self.ecmp_preds.get(dpid)
+            if pred is None or dst_dpid not in pred:
+                self.logger.error("No path s%d -> s%d", dpid, dst_dpid)
+                return
             try:
-                graph_to_use = self.topology_graph if self.topology_graph.number_of_nodes() > 0 else self.graph
-                all_paths = list(nx.all_shortest_paths(
-                    graph_to_use, source=src_node, target=dst_node, weight='weight'))
-                if self.ecmp_enabled and len(all_paths) > 1:
-                    path = random.choice(all_paths)
-                    self.logger.info("ECMP: %s (%d paths) -> %s",
-                                     src_node, len(all_paths), path)
+                if self.ecmp_enabled:
+                    # Hash the flow, as switch ECMP does: one flow, one path
+                    if tcp_ports:
+                        # IPv4 src/dst addresses, proto, TCP ports
+                        key = msg.data[26:34] + struct.pack('!BHH', 6, *tcp_ports)
+                    else:
+                        key = src + dst
+                    path, forks = self._walk_path(pred, dpid, dst_dpid, key)
+                    # Per new flow: skip building the arguments when INFO is off
+                    if forks and self.logger.isEnabledFor(logging.INFO):
+                        self.logger.info("ECMP: s%d (%d forks) -> %s",
+                                         dpid, forks, path)
                 else:
-                    path = all_paths[0]
-                self.flow_to_path[path_key] = path
+                    path = self._walk_path(pred, dpid, dst_dpid)[0]
+                # Resolve every hop's output port once, when the path is chosen
+                outports = {sw: self.link_to_port[sw][nxt]
+                            for sw, nxt in zip(path, path[1:])}
+                outports[path[-1]] = dst_port
+                self.path_outport[path_key] = outports
+                if src_port is not None:
+                    # Reply traffic takes the same path back
+                    rev_path = path[::-1]
+                    rev_ports = {sw: self.link_to_port[sw][nxt]
+                                 for sw, nxt in zip(rev_path, rev_path[1:])}
+                    rev_ports[dpid] = src_port
+                    rev_key = self.flow_key(dst_dpid, dpid, src_id,
+                                            *(tcp_ports[::-1] if tcp_ports else (0, 0)))
+                    self.path_outport[rev_key] = rev_ports
                 # Install rules
-                self.install_path_rules(path, dst, dst_port, tcp_pkt)
-            except nx.NetworkXNoPath:
-                self.logger.error("No path s%d -> s%d", dpid, dst_dpid)
+                self.install_path_rules(path, dst.hex(':'), dst_port, tcp_ports,
+                                        src_mac=src.hex(':'), src_port=src_port)
+            except KeyError as e:
+                # Cached DAG and port map disagree (a rebuild is pending):
+                # flood this packet, the next one gets the rebuilt tables
+                self.logger.warning("No cached port for s%d -> s%d (%s), flooding",
+                                    dpid, dst_dpid, e)
+                self.flood_packet(datapath, msg, in_port)
                 return
             except Exception as e:
                 self.logger.error("Path computation error: %s", str(e))
                 return
         
-        # Forward this packet
-        path = self.flow_to_path[path_key]
-        out_port = self.get_outport(dpid, path, dst_port)
+        # Forward this packet. Use the local outports: the sends above can
+        # yield, and a topology rebuild may clear the shared tables meanwhile
+        out_port = outports.get(dpid)
         if out_port is None:
             self.logger.warning("Cannot forward on s%d, flooding", dpid)
             self.flood_packet(datapath, msg, in_port)
             return
-        actions = [parser.OFPActionOutput(out_port)]
+        actions = self._out(dpid, out_port)[0]
         data = None
-        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+        if msg.buffer_id == OFP_NO_BUFFER:
             data = msg.data
-        out = parser.OFPPacketOut(
+        out = OFPPacketOut(
             datapath=datapath, buffer_id=msg.buffer_id,
             in_port=in_port, actions=actions, data=data)
+        send(out)
+
+    @staticmethod
+    def flow_key(dpid, dst_dpid, dst_id, tcp_src, tcp_dst):
+        """Pack a flow identity into a single int dict key: 64-bit dpids,
+        32-bit MAC id, 16-bit TCP ports, each in its own bit range"""
+        return (dpid << 128) | (dst_dpid << 64) | (dst_id << 32) | (tcp_src << 16) | tcp_dst
+
+    def handle_arp(self, datapath, msg, in_port, flood=True):
+        """Answer ARP requests for known IPs directly; flood the rest"""
+        arp_pkt = parse_arp(msg.data)
+        if arp_pkt is None:
+            return
+        op, sha, spa, tpa = arp_pkt
+        if spa != b'\x00\x00\x00\x00':  # skip ARP probes
+            self.ip_to_mac[spa] = sha
+        target_mac = self.ip_to_mac.get(tpa) if op == 1 else None
+        if target_mac is None:
+            if flood:
+                self.flood_packet(datapath, msg, in_port)
+            return
+        out = OFPPacketOut(
+            datapath=datapath, buffer_id=OFP_NO_BUFFER,
+            in_port=OFPP_CONTROLLER, actions=self._out(datapath.id, in_port)[0],
+            data=build_arp_reply(sha, spa, target_mac, tpa))
         datapath.send_msg(out)
+        if msg.buffer_id != OFP_NO_BUFFER:
+            # Release the buffered request without forwarding it
+            datapath.send_msg(OFPPacketOut(
+                datapath=datapath, buffer_id=msg.buffer_id,
+                in_port=in_port, actions=[], data=None))
+
+    def install_local_flow(self, datapath, msg, in_port, src, dst, dst_port):
+        """Switch-local host pair: install an eth_src/eth_dst rule and forward"""
+        match = OFPMatch(eth_src=src.hex(':'), eth_dst=dst.hex(':'))
+        actions, inst = self._out(datapath.id, dst_port)
+        # A buffered packet is released by the switch through the new rule
+        datapath.send_msg(self.build_flow(datapath, 8, match, inst=inst,
+                                          buffer_id=msg.buffer_id, idle_timeout=30))
+        if msg.buffer_id != OFP_NO_BUFFER:
+            return
+        datapath.send_msg(OFPPacketOut(
+            datapath=datapath, buffer_id=OFP_NO_BUFFER,
+            in_port=in_port, actions=actions, data=msg.data))
 
     def flood_packet(self, datapath, msg, in_port):
         """Flood a packet"""
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
-        actions = [parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
+        actions = self._out(datapath.id, OFPP_FLOOD)[0]
         data = None
-        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+        if msg.buffer_id == OFP_NO_BUFFER:
             data = msg.data
-        out = parser.OFPPacketOut(
+        out = OFPPacketOut(
             datapath=datapath, buffer_id=msg.buffer_id,
             in_port=in_port, actions=actions, data=data)
         datapath.send_msg(out)
 
-    def install_path_rules(self, path, dst_mac, final_port, tcp_pkt, src_mac=None, src_port=None):
-        """Install flow rules on all switches in path (bidirectional for TCP)"""
-        for i, switch_name in enumerate(path):
-            switch_id = int(switch_name[1:])
+    def install_path_rules(self, path, dst_mac, final_port, tcp_ports, src_mac=None, src_port=None):
+        """Install flow rules on all switches in path (both ways if src_port is given)"""
+        pending = []  # (datapath, [FlowMod, ...]) per switch on the path
+        for i, switch_id in enumerate(path):
             if switch_id not in self.datapaths:
                 continue
             
             datapath = self.datapaths[switch_id]
-            parser = datapath.ofproto_parser
+            mods = []
+            pending.append((datapath, mods))
+            link_ports = self.link_to_port.get(switch_id, {})
             
             # Determine forward output port
             if i < len(path) - 1:
-                next_switch_id = int(path[i+1][1:])
-                fwd_out_port = self.link_to_port[(switch_id, next_switch_id)]
+                next_switch_id = path[i+1]
+                fwd_out_port = link_ports[next_switch_id]
             else:
                 fwd_out_port = final_port
             
             # === FORWARD DIRECTION ===
-            if tcp_pkt:
-                # TCP-specific match for per-flow ECMP
-                fwd_match = parser.OFPMatch(
+            if tcp_ports and i == 0:
+                # TCP-specific match at the ingress, where ECMP picks the path
+                fwd_match = OFPMatch(
                     eth_type=0x0800,
                     eth_dst=dst_mac,
                     ip_proto=6,
-                    tcp_src=tcp_pkt.src_port,
-                    tcp_dst=tcp_pkt.dst_port)
+                    tcp_src=tcp_ports[0],
+                    tcp_dst=tcp_ports[1])
                 priority = 10
+                fwd_key = (switch_id, dst_mac, None, tcp_ports[0], tcp_ports[1])
+            elif tcp_ports and src_mac:
+                # Transit: one rule per host pair, whatever the TCP ports
+                fwd_match = OFPMatch(eth_dst=dst_mac, eth_src=src_mac)
+                priority = 8
+                fwd_key = (switch_id, dst_mac, src_mac, None, None)
             else:
                 # Generic match for non-TCP
-                fwd_match = parser.OFPMatch(eth_dst=dst_mac)
+                fwd_match = OFPMatch(eth_dst=dst_mac)
                 priority = 5
+                fwd_key = (switch_id, dst_mac, None, None, None)
             
-            fwd_actions = [parser.OFPActionOutput(fwd_out_port)]
-            self.add_flow(datapath, priority, fwd_match, fwd_actions)
+            # Skip rules the switch already has from an earlier flow
+            if self.installed_rules.get(fwd_key) != fwd_out_port:
+                mods.append(self.build_flow(datapath, priority, fwd_match,
+                                            flags=OFPFF_SEND_FLOW_REM,
+                                            inst=self._out(switch_id, fwd_out_port)[1]))
+                self.installed_rules[fwd_key] = fwd_out_port
             
-            # === REVERSE DIRECTION (for TCP only) ===
-            if tcp_pkt and src_mac and src_port is not None:
+            # === REVERSE DIRECTION ===
+            if src_mac and src_port is not None:
                 # Determine reverse output port
                 if i > 0:
-                    prev_switch_id = int(path[i-1][1:])
-                    rev_out_port = self.link_to_port[(switch_id, prev_switch_id)]
+                    prev_switch_id = path[i-1]
+                    rev_out_port = link_ports[prev_switch_id]
                 else:
                     rev_out_port = src_port
                 
-                # Reverse match (swap src/dst ports)
-                rev_match = parser.OFPMatch(
-                    eth_type=0x0800,
-                    eth_dst=src_mac,
-                    ip_proto=6,
-                    tcp_src=tcp_pkt.dst_port,  # Swapped!
-                    tcp_dst=tcp_pkt.src_port)  # Swapped!
-                
-                rev_actions = [parser.OFPActionOutput(rev_out_port)]
-                self.add_flow(datapath, priority, rev_match, rev_actions)
-
+                if not tcp_ports:
+                    rev_match = OFPMatch(eth_dst=src_mac)
+                    rev_priority = 5
+                    rev_key = (switch_id, src_mac, None, None, None)
+                elif i == len(path) - 1:
+                    # Reverse match (swap src/dst ports) at the reverse ingress
+                    rev_match = OFPMatch(
+                        eth_type=0x0800,
+                        eth_dst=src_mac,
+                        ip_proto=6,
+                        tcp_src=tcp_ports[1],  # Swapped!
+                        tcp_dst=tcp_ports[0])  # Swapped!
+                    rev_priority = 10
+                    rev_key = (switch_id, src_mac, None, tcp_ports[1], tcp_ports[0])
+                else:
+                    rev_match = OFPMatch(eth_dst=src_mac, eth_src=dst_mac)
+                    rev_priority = 8
+                    rev_key = (switch_id, src_mac, dst_mac, None, None)
+                if self.installed_rules.get(rev_key) != rev_out_port:
+                    mods.append(self.build_flow(datapath, rev_priority, rev_match,
+                                                flags=OFPFF_SEND_FLOW_REM,
+                                                inst=self._out(switch_id, rev_out_port)[1]))
+                    self.installed_rules[rev_key] = rev_out_port
+        
+        # Egress first, so downstream rules are queued before the ingress
+        # rule that starts steering the flow onto this path
+        for datapath, mods in reversed(pending):
+            if mods:
+                self.send_flows(datapath, mods)
 
-    def get_outport(self, switch_id, path, final_port):
-        """Get output port for switch given path"""
-        switch_name = f's{switch_id}'
-        # Check if this switch is in the path
-        if switch_name not in path:
-            self.logger.error("Switch %s not in path %s", switch_name, path)
+    def install_group_rules(self, src_dpid, dst_dpid, dst_mac, final_port):
+        """
+        Install eth_dst rules on every switch of the src -> dst shortest-path
+        DAG. Switches with several equal-cost next hops forward into a
+        SELECT group so the switch, not the controller, spreads flows.
+        Returns the actions for the ingress switch, or None if no path.
+        """
+        pred = self.ecmp_preds.get(src_dpid)
+        if pred is None or dst_dpid not in pred:
             return None
-        idx = path.index(switch_name)
-        if idx < len(path) - 1:
-            next_id = int(path[idx+1][1:])
-            port = self.link_to_port.get((switch_id, next_id))
-            if port is None:
-                self.logger.error("No port mapping for s%d -> s%d", switch_id, next_id)
-                return None
-            return port
-        else:
-            return final_port
\ No newline at end of file
+        # Collect next hops of every DAG node on a path to dst
+        next_hops = {dst_dpid: []}
+        stack = [dst_dpid]
+        while stack:
+            node = stack.pop()
+            for prev in pred[node]:
+                if prev not in next_hops:
+                    next_hops[prev] = []
+                    stack.append(prev)
+                next_hops[prev].append(node)
+        ingress_actions = None
+        # next_hops is filled from dst outwards, so bundles go egress first
+        for switch_id, hops in next_hops.items():
+            datapath = self.datapaths.get(switch_id)
+            if datapath is None:
+                continue
+            if hops:
+                link_ports = self.link_to_port[switch_id]
+                ports = tuple(sorted(link_ports[nxt] for nxt in hops))
+            else:
+                ports = (final_port,)
+            mods = []  # a new group must precede the rule that uses it
+            if len(ports) > 1:
+                gid = self._select_group(datapath, ports, mods)
+                actions = [OFPActionGroup(gid)]
+                rule = ('group', gid)
+            else:
+                actions = self._out(switch_id, ports[0])[0]
+                rule = ports[0]
+            if switch_id == src_dpid:
+                ingress_actions = actions
+            key = (switch_id, dst_mac, None, None, None)
+            if self.installed_rules.get(key) != rule:
+                mods.append(self.build_flow(
+                    datapath, 5, OFPMatch(eth_dst=dst_mac), actions,
+                    flags=OFPFF_SEND_FLOW_REM))
+                self.installed_rules[key] = rule
+            if mods:
+                self.send_flows(datapath, mods)
+        return ingress_actions
+
+    def _select_group(self, datapath, ports, mods):
+        """SELECT group over ports on a switch, returns its id; a new group's
+        GroupMod is appended to mods"""
+        gid = self.group_ids.get((datapath.id, ports))
+        if gid is not None:
+            return gid
+        gid = self.next_group_id
+        self.next_group_id += 1
+        buckets = [OFPBucket(weight=1, actions=[OFPActionOutput(port)]) for port in ports]
+        mods.append(OFPGroupMod(datapath, command=OFPGC_ADD, type_=OFPGT_SELECT,
+                                group_id=gid, buckets=buckets))
+        self.group_ids[(datapath.id, ports)] = gid
+        return gid
@@ -8,14 +8,18 @@ from mininet.log import setLogLevel, info
 def hex_dpid(n: int) -> str:
     return f"{int(n):016x}"
 
+def run_batch(node, cmds):
+    # One shell round-trip for the whole sequence instead of one per command
+    return node.cmd('; '.join(cmds))
+
 def set_if(node, ifname, ip_cidr=None, mac=None):
-    node.cmd(f'ip link set dev {ifname} down')
-    node.cmd(f'ip addr flush dev {ifname}')
+    cmds = [f'ip link set dev {ifname} down', f'ip addr flush dev {ifname}']
     if mac:
-        node.cmd(f'ip link set dev {ifname} address {mac}')
+        cmds.append(f'ip link set dev {ifname} address {mac}')
     if ip_cidr:
-        node.cmd(f'ip addr add {ip_cidr} dev {ifname}')
-    node.cmd(f'ip link set dev {ifname} up')
+        cmds.append(f'ip addr add {ip_cidr} dev {ifname}')
+    cmds.append(f'ip link set dev {ifname} up')
+    run_batch(node, cmds)
 
 def build():
     net = Mininet(
@@ -54,15 +58,15 @@ def build():
     net.start()
 
     info('*** Configure hosts: IP/MAC + default routes\n')
-    h1.cmd('ip addr flush dev h1-eth1')
-    h1.cmd('ip addr add 10.0.12.2/24 dev h1-eth1')
-    h1.cmd('ip link set h1-eth1 address 00:00:00:00:01:02 up')
-    h1.cmd('ip route add default via 10.0.12.1 dev h1-eth1')
-
-    h2.cmd('ip addr flush dev h2-eth1')
-    h2.cmd('ip addr add 10.0.67.2/24 dev h2-eth1')
-    h2.cmd('ip link set h2-eth1 address 00:00:00:00:06:02 up')
-    h2.cmd('ip route add default via 10.0.67.1 dev h2-eth1')
+    run_batch(h1, ['ip addr flush dev h1-eth1',
+                   'ip addr add 10.0.12.2/24 dev h1-eth1',
+                   'ip link set h1-eth1 address 00:00:00:00:01:02 up',
+                   'ip route add default via 10.0.12.1 dev h1-eth1'])
+
+    run_batch(h2, ['ip addr flush dev h2-eth1',
+                   'ip addr add 10.0.67.2/24 dev h2-eth1',
+                   'ip link set h2-eth1 address 00:00:00:00:06:02 up',
+                   'ip route add default via 10.0.67.1 dev h2-eth1'])
 
     info('*** Assign gateway IPs/MACs on host-facing switch ports\n')
     set_if(s1, 's1-eth1', ip_cidr='10.0.12.1/24', mac='00:00:00:00:01:01')  # GW for h1
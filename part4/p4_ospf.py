@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 # frr_ospf.py — FRR (zebra + ospfd) config/start/stop + convergence wait
 
+import os
+import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 FRR_BIN_ZEBRA = "/usr/lib/frr/zebra"
 FRR_BIN_OSPFD = "/usr/lib/frr/ospfd"
@@ -21,35 +24,38 @@ def start_frr_ospf(net, meta, host_if_cost=1):
     r1_if_ip = meta["host_links"]["s1_if_ip"]
     rn_if_ip = meta["host_links"]["sn_if_ip"]
 
-    for rname in meta["routers"]:
+    def _setup_router(rname):
         n = net.get(rname)
-        n.cmd(f"rm -rf /tmp/{rname} && install -d -m 0777 /tmp/{rname}/run /tmp/{rname}/log")
+        # /tmp is shared with the netns: prepare it from here, no shell needed
+        rdir = f"/tmp/{rname}"
+        shutil.rmtree(rdir, ignore_errors=True)
+        for sub in ("run", "log"):
+            os.makedirs(f"{rdir}/{sub}", exist_ok=True)
+            os.chmod(f"{rdir}/{sub}", 0o777)
 
         r1_if_name = _iface_by_ip(n, r1_if_ip)
         rn_if_name = _iface_by_ip(n, rn_if_ip)
 
-        n.cmd(f"bash -lc \"cat > /tmp/{rname}/zebra.conf <<'EOF'\n"
-              f"log file /tmp/{rname}/log/zebra.log\n"
-              f"EOF\"")
+        with open(f"{rdir}/zebra.conf", "w") as f:
+            f.write(f"log file {rdir}/log/zebra.log\n")
 
         # Minimal ospfd.conf with per-interface costs
-        n.cmd(f"bash -lc \"cat > /tmp/{rname}/ospfd.conf <<'EOF'\n"
-              f"log file /tmp/{rname}/log/ospfd.log\n"
-              f"router ospf\n"
-              f" router-id {int(rname[1:])}.{int(rname[1:])}.{int(rname[1:])}.{int(rname[1:])}\n"
-              f" network 10.0.0.0/8 area 0\n"
-              f" network 10.255.0.0/16 area 0\n"
-              f"!\n"
-              + "\n".join(
-                    f"interface {ifn}\n ip ospf cost {cost}\n!"
-                    for ifn, cost in if_costs[rname].items()
-                ) + "\n"
-              + (f"interface {r1_if_name}\n ip ospf cost {host_if_cost}\n ip ospf passive\n!\n"
-                 if r1_if_name else "")
-              + (f"interface {rn_if_name}\n ip ospf cost {host_if_cost}\n ip ospf passive\n!\n"
-                 if rn_if_name else "")
-              + "line vty\n exec-timeout 0 0\n login\n!\n"
-              + "EOF\"")
+        with open(f"{rdir}/ospfd.conf", "w") as f:
+            f.write(f"log file {rdir}/log/ospfd.log\n"
+                    f"router ospf\n"
+                    f" router-id {int(rname[1:])}.{int(rname[1:])}.{int(rname[1:])}.{int(rname[1:])}\n"
+                    f" network 10.0.0.0/8 area 0\n"
+                    f" network 10.255.0.0/16 area 0\n"
+                    f"!\n"
+                    + "\n".join(
+                          f"interface {ifn}\n ip ospf cost {cost}\n!"
+                          for ifn, cost in if_costs[rname].items()
+                      ) + "\n"
+                    + (f"interface {r1_if_name}\n ip ospf cost {host_if_cost}\n ip ospf passive\n!\n"
+                       if r1_if_name else "")
+                    + (f"interface {rn_if_name}\n ip ospf cost {host_if_cost}\n ip ospf passive\n!\n"
+                       if rn_if_name else "")
+                    + "line vty\n exec-timeout 0 0\n login\n!\n")
 
         # Start daemons in the netns
         n.cmd(f"{FRR_BIN_ZEBRA} -d -f /tmp/{rname}/zebra.conf "
@@ -57,23 +63,31 @@ def start_frr_ospf(net, meta, host_if_cost=1):
         n.cmd(f"{FRR_BIN_OSPFD} -d -f /tmp/{rname}/ospfd.conf "
               f"-i /tmp/{rname}/run/ospfd.pid -z /tmp/{rname}/run/zserv.api")
 
+    # Routers live in independent netns; configure and start them concurrently
+    with ThreadPoolExecutor(max_workers=min(32, len(meta["routers"]))) as ex:
+        list(ex.map(_setup_router, meta["routers"]))
+
     print('*** FRR (zebra+ospfd) started on all routers; waiting a bit…')
     time.sleep(3)
 
-def wait_for_convergence(net, meta, timeout=120, poll=1.0):
-    """Convergence proxy: r1 has OSPF route to h2/24 AND rN has route to h1/24."""
+def wait_for_convergence(net, meta, timeout=120, poll=0.25, first_poll=0.05):
+    """Convergence proxy: r1 has OSPF route to h2/24 AND rN has route to h1/24.
+    Polls start at first_poll and back off by 1.5x up to poll."""
     r1_dst = meta["host_links"]["h2_ip"].rsplit('.', 1)[0] + ".0/24"
     rN_dst = meta["host_links"]["h1_ip"].rsplit('.', 1)[0] + ".0/24"
-    deadline = time.time() + timeout
+    deadline = time.monotonic() + timeout
     r1 = net.get("s1")
     rN = net.get(meta["routers"][-1])
 
-    while time.time() < deadline:
-        r1_ok = r1_dst in r1.cmd("ip route | grep 'proto ospf' || true")
-        rN_ok = rN_dst in rN.cmd("ip route | grep 'proto ospf' || true")
+    interval = first_poll
+    while time.monotonic() < deadline:
+        # One ip exec per router, filtered by the kernel: no shell pipe to grep
+        r1_ok = r1_dst in r1.cmd(f"ip -4 route show {r1_dst} proto ospf")
+        rN_ok = r1_ok and rN_dst in rN.cmd(f"ip -4 route show {rN_dst} proto ospf")
         if r1_ok and rN_ok:
             return True
-        time.sleep(poll)
+        time.sleep(min(interval, max(0, deadline - time.monotonic())))
+        interval = min(poll, interval * 1.5)
     return False
 
 def stop_frr(net, meta):
@@ -86,24 +100,19 @@ def stop_frr(net, meta):
         n.cmd("pkill -9 zebra || true")
         n.cmd("pkill -9 ospfd || true")
 
-def find_switch_info(switches, s_name, neighbor):
-    for x in switches:
-        if x["name"] == s_name:
-            for intf in x["interfaces"]:
-                if intf["neighbor"] == neighbor:
-                    return intf
-            
-            
 def generate_meta_ospf(conf):
     switches = conf["switches"]
     links = conf["links"]
     routers = [switch["name"] for switch in switches]
+    # (switch, neighbor) -> interface, built once instead of scanned per lookup
+    intf_index = {(sw["name"], intf["neighbor"]): intf
+                  for sw in switches for intf in sw.get("interfaces", [])}
     edges = []
     for link in links:
         s_i = link["src"]
         s_j = link["dst"]
-        intf_info_i = find_switch_info(switches, s_i, s_j)
-        intf_info_j = find_switch_info(switches, s_j, s_i)
+        intf_info_i = intf_index[(s_i, s_j)]
+        intf_info_j = intf_index[(s_j, s_i)]
         edges.append({
                         "s_i": s_i,
                         "s_j": s_j,
@@ -115,8 +124,8 @@ def generate_meta_ospf(conf):
                         "cost": link["cost"]
                     })
     hosts = conf["hosts"]
-    r1_h_ip = find_switch_info(switches, switches[0]["name"], "h1")["ip"]
-    rn_h_ip = find_switch_info(switches, switches[-1]["name"], "h2")["ip"]
+    r1_h_ip = intf_index[(switches[0]["name"], "h1")]["ip"]
+    rn_h_ip = intf_index[(switches[-1]["name"], "h2")]["ip"]
     host_links =  {
         "h1_ip": f"{hosts[0]['ip']}/24", "s1_if_ip": f'{r1_h_ip}/24',
         "h2_ip": f"{hosts[-1]['ip']}/24", "sn_if_ip": f'{rn_h_ip}/24'
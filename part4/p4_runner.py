@@ -1,61 +1,115 @@
 #!/usr/bin/env python3
 # main.py — orchestrates: build topo → start FRR/OSPF → wait → flap & iperf → (optional CLI)
 
-import argparse, json
-from mininet.cli import CLI
+import argparse, functools, json, os, shutil, subprocess
 from mininet.log import setLogLevel, info
 from p4_topo import build, H1_IP, H2_IP
 from p4_ospf import start_frr_ospf, wait_for_convergence, stop_frr, generate_meta_ospf
 from pathlib import Path
-import random
 import time
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 def if_down_up(net, edge, down=True):
     """Bring both sides of a router-router link down/up."""
-    ri, rj = net.get(edge["s_i"]), net.get(edge["s_j"])
-    ifs = (edge["i_if"], edge["j_if"])
+    if "_nodes" not in edge:
+        edge["_nodes"] = (net.get(edge["s_i"]), net.get(edge["s_j"]))
+        edge["_ifs"] = (edge["i_if"], edge["j_if"])
+    ri, rj = edge["_nodes"]
+    ifs = edge["_ifs"]
     action = "down" if down else "up"
-    ri.cmd(f"ip link set {ifs[0]} {action}")
-    rj.cmd(f"ip link set {ifs[1]} {action}")
+    # send to both shells before waiting so the two ends change together
+    ri.sendCmd(f"ip link set {ifs[0]} {action}")
+    rj.sendCmd(f"ip link set {ifs[1]} {action}")
+    ri.waitOutput()
+    rj.waitOutput()
+
+_LOG_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC
+
+@functools.lru_cache(maxsize=1)
+def _have_iperf3():
+    # hosts share the root filesystem, so one lookup here covers all of them
+    return shutil.which("iperf3") is not None
 
 def start_iperf(h1, h2, h1_ip, h2_ip, total_seconds, prefer_iperf3=True):
-    """Start server on h2, client on h1. Returns (server_log, client_log)."""
+    """Start server on h2, client on h1.
+    Returns (server_log, client_log, server_proc, client_proc)."""
     s_log = "h2_iperf.log"
     c_log = "h1_iperf.log"
-    have_iperf3 = prefer_iperf3 and ("iperf3" in h1.cmd("which iperf3"))
+    ip = h2_ip.split("/")[0]
+    have_iperf3 = prefer_iperf3 and _have_iperf3()
     if have_iperf3:
-        h2.cmd(f"iperf3 -s -1 > {s_log} 2>&1 &")
-        time.sleep(0.5)
-        ip = h2_ip.split("/")[0]
-        h1.cmd(f"iperf3 -c {ip} -t {int(total_seconds)} -i 1 > {c_log} 2>&1 &")
+        s_cmd = ["iperf3", "-s", "-1"]
+        c_bin, port = "iperf3", 5201
     else:
-        h2.cmd(f"iperf -s > {s_log} 2>&1 &")
-        time.sleep(0.5)
-        ip = h2_ip.split("/")[0]
-        h1.cmd(f"iperf -c {ip} -t {int(total_seconds)} -i 1 > {c_log} 2>&1 &")
-    return s_log, c_log
+        s_cmd = ["iperf", "-s"]
+        c_bin, port = "iperf", 5001
+    # popen skips the hosts' interactive shells; the children get the log fds
+    # dup'd onto stdout/stderr, so ours are CLOEXEC and closed straight away
+    fd = os.open(s_log, _LOG_FLAGS, 0o644)
+    try:
+        s_proc = h2.popen(s_cmd, stdout=fd, stderr=subprocess.STDOUT)
+    finally:
+        os.close(fd)
+    # wait for the server to bind rather than a fixed 0.5s
+    # stderr dropped and the port matched, so an ss error can't pass as ready
+    probe = f"ss -Hltn 'sport = :{port}' 2>/dev/null"
+    bound = f":{port} "
+    for _ in range(40):
+        if bound in h2.cmd(probe) or s_proc.poll() is not None:
+            break
+        time.sleep(0.025)
+    fd = os.open(c_log, _LOG_FLAGS, 0o644)
+    try:
+        c_proc = h1.popen([c_bin, "-c", ip, "-t", str(int(total_seconds)), "-i", "1"],
+                          stdout=fd, stderr=subprocess.STDOUT)
+    finally:
+        os.close(fd)
+    return s_log, c_log, s_proc, c_proc
+
+def _read_log(path):
+    try:
+        return Path(path).read_text(errors="replace")
+    except FileNotFoundError:
+        return ""
 
 def link_flap_exp(net, e, h1_ip, h2_ip, iperf_time = 15, link_down_duration = 5, link_down_time = 2):
     """Choose distinct edges and flap them in sequence."""
     h1, h2 = net.get("h1"), net.get("h2")
-    s_log, c_log = start_iperf(h1, h2, h1_ip, h2_ip, iperf_time)
+    s_log, c_log, s_proc, c_proc = start_iperf(h1, h2, h1_ip, h2_ip, iperf_time)
+    # phases are deadlines from t0, so if_down_up latency doesn't push them later
+    t0 = time.monotonic()
 
     print(f"*** iperf running: client log {c_log}, server log {s_log}")
 
-    time.sleep(link_down_time)
+    time.sleep(max(0, t0 + link_down_time - time.monotonic()))
 
     key = (e["s_i"], e["s_j"], e["i_if"], e["j_if"])
     print(f"DOWN {e['s_i']}:{e['i_if']} <-> {e['s_j']}:{e['j_if']} for {link_down_duration}s")
     if_down_up(net, e, down=True) ## code to toggle the link
-    time.sleep(link_down_duration)
+    time.sleep(max(0, t0 + link_down_time + link_down_duration - time.monotonic()))
     print(f"UP   {e['s_i']}:{e['i_if']} <-> {e['s_j']}:{e['j_if']}")
     if_down_up(net, e, down=False)
 
     print("*** Flaps done; waiting a few seconds for iperf to finish…")
-    time.sleep(iperf_time-link_down_duration-link_down_time)
+    try:
+        c_proc.wait(timeout=max(0, t0 + iperf_time - time.monotonic()) + 10)
+    except subprocess.TimeoutExpired:
+        c_proc.kill()
+        c_proc.wait()
+    # iperf3 -s -1 exits after its one test; plain iperf -s never does
+    try:
+        s_proc.wait(timeout=2)
+    except subprocess.TimeoutExpired:
+        s_proc.terminate()
+        s_proc.wait()
 
-    c_out = h1.cmd(f"tail -n +1 {c_log} || true")
-    s_out = h2.cmd(f"tail -n +1 {s_log} || true")
+    # logs are on the shared filesystem, no need to go through the hosts' shells
+    c_out, s_out = _read_log(c_log), _read_log(s_log)
     return c_log, s_log, c_out, s_out
 
 
@@ -67,14 +121,16 @@ def main():
     ap.add_argument("--converge-timeout", type=int, default=120, help="Seconds to wait for initial convergence")
     ap.add_argument("--flap-iters", type=int, default=1, help="How many flap cycles")
     ap.add_argument("--stabilize", type=int, default=40, help="Seconds to wait after bringing link UP")
-    ap.add_argument("--no-cli", action="store_true", help="Exit after test (no Mininet CLI)")
+    ap.add_argument("--cli", action="store_true", help="Drop to the Mininet CLI after the test")
+    # old opt-out flag; exiting after the test is now the default
+    ap.add_argument("--no-cli", action="store_true", help=argparse.SUPPRESS)
     ap.add_argument("--router-bw", type=int, default=10, help="bw (Mbps) for router-router links")
     ap.add_argument("--h1-bw", type=int, default=100, help="bw (Mbps) for h1↔s1 link")
     ap.add_argument("--h2-bw", type=int, default=50, help="bw (Mbps) for h2↔sN link")
     args = ap.parse_args()
 
     with open(args.input_file) as f:
-        config = json.load(f)
+        config = _loads(f.read())
 
     a_str, b_str = args.subnet_start.split(".")
     start_a, start_b = int(a_str), int(b_str)
@@ -82,6 +138,7 @@ def main():
     # 1) Topology
     net = build()
     meta_ospf = generate_meta_ospf(config)
+    meta_ospf["edge_index"] = {(x["s_i"], x["s_j"]): x for x in meta_ospf["edges"]}
     
     try:
         # 2) FRR
@@ -96,10 +153,7 @@ def main():
             print("⚠️  OSPF did not converge within timeout; continuing anyway.")
 
         # 4) Link flap experiment
-        e = None
-        for x in meta_ospf["edges"]:
-            if x["s_i"] == "s2" and x["s_j"] == "s3":
-                e = x
+        e = meta_ospf["edge_index"].get(("s2", "s3"))
         c_log, s_log, c_out, s_out = link_flap_exp(
             net, e, h1_ip=H1_IP, h2_ip=H2_IP)
 
@@ -107,11 +161,12 @@ def main():
         print("\n==== iperf SERVER (h2) ====\n" + s_out)
 
         # 5) Optional CLI for inspection
-        if not args.no_cli:
+        if args.cli:
             print("\n*** Examples:")
             print("  s1 ip route")
             print("  s2 vtysh -c 'show ip ospf neighbor'")
             print("  h1 ping -c 3 h2")
+            from mininet.cli import CLI
             CLI(net)
     finally:
         # Cleanup